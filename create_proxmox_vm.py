@@ -1,32 +1,68 @@
 #!/usr/bin/env python3
 
 import argparse
+import atexit
+import copy
 import os
 import pathlib
-import requests
-import time
-import urllib3
+import tempfile
 import uuid
 import yaml
+from concurrent.futures import ThreadPoolExecutor
 from getpass import getpass
-from proxmoxer.core import AuthenticationError
+from shlex import quote
 from urllib import parse as urlparse
 
 from lib.config import load_config
 from lib.defaults import load_defaults
 from lib.log import *
-from lib.proxmox import ProxmoxNode
 
+try:
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeLoader, SafeDumper
 
-CREDENTIALS_FILE = os.path.join(pathlib.Path.home(), '.proxmox_credentials.yaml')
 
+CREDENTIALS_DIR = os.path.join(pathlib.Path.home(), '.proxmox_credentials.d')
+LEGACY_CREDENTIALS_FILE = os.path.join(pathlib.Path.home(), '.proxmox_credentials.yaml')
 
-def load_credentials(filename):
+# filename -> (st_mtime_ns, st_size, parsed credentials)
+_CRED_CACHE = {}
+
+# HTTP session shared by all client-side downloads, created on first use
+_SESSION = None
+
+
+def cache_credentials(filename, data, stat=None):
+    if stat is None:
+        stat = os.stat(filename)
+    _CRED_CACHE[filename] = (stat.st_mtime_ns, stat.st_size, copy.deepcopy(data))
+
+
+def get_session():
+    global _SESSION
+    if _SESSION is None:
+        import requests
+        _SESSION = requests.Session()
+    return _SESSION
+
+
+def credentials_file(dirname, server):
+    """Return the file holding the credentials of a single server."""
+    return os.path.join(dirname, urlparse.quote(server, safe='') + '.yaml')
+
+
+def load_credentials_file(filename):
     try:
-        with open(filename) as fd:
-            data = yaml.safe_load(fd)
+        stat = os.stat(filename)
+        cached = _CRED_CACHE.get(filename)
+        if cached and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+            return copy.deepcopy(cached[2])
+        with open(filename, 'rb') as fd:
+            data = yaml.load(fd, Loader=SafeLoader)
             if data:
                 debug('Loading credentials from:', filename)
+                cache_credentials(filename, data, stat)
                 return data
     except FileNotFoundError:
         pass
@@ -36,42 +72,95 @@ def load_credentials(filename):
     return {}
 
 
-def save_credentials(filename, server, password):
-    data = load_credentials(filename)
-    data.update({ server: password })
+def load_credentials(dirname):
+    data = {}
     try:
-        with open(filename, 'w') as fd:
-            info('Saving credentials to:', filename)
-            yaml.dump(data, fd)
-        os.chmod(filename, 0o600)
-    except:
+        with os.scandir(dirname) as entries:
+            for entry in entries:
+                if entry.name.endswith('.yaml'):
+                    data.update(load_credentials_file(entry.path))
+    except FileNotFoundError:
         pass
+    return data
+
+
+def save_credentials(dirname, server, password, log=info):
+    filename = credentials_file(dirname, server)
+    data = { server: password }
+    temp_file = None
+    try:
+        os.makedirs(dirname, mode=0o700, exist_ok=True)
+        # write to a temp file and rename it, so an interrupted write
+        # never leaves a truncated credentials file behind
+        with tempfile.NamedTemporaryFile('w', dir=dirname, suffix='.tmp',
+                                         delete=False) as fd:
+            temp_file = fd.name
+            log('Saving credentials to:', filename)
+            yaml.dump(data, fd, Dumper=SafeDumper)
+        os.chmod(temp_file, 0o600)
+        os.replace(temp_file, filename)
+        cache_credentials(filename, data)
+    except:
         warning('Could not access file:', filename)
+        # do not leave the password behind in a stray temp file
+        if temp_file:
+            try:
+                os.remove(temp_file)
+            except OSError:
+                pass
 
 
-def clean_credentials(filename, server):
-    data = load_credentials(filename)
-    del(data[server])
+def clean_credentials(dirname, server):
+    filename = credentials_file(dirname, server)
+    _CRED_CACHE.pop(filename, None)
     try:
-        with open(filename, 'w') as fd:
-            debug('Cleaning credentials from:', filename)
-            yaml.dump(data, fd)
+        os.remove(filename)
+        debug('Cleaning credentials from:', filename)
     except:
         pass
 
 
+def migrate_credentials(filename, dirname):
+    """Split a legacy single-file credentials store into one file per server.
+
+    Runs for as long as the legacy file exists, so servers that could not
+    be migrated are retried on the next run.
+    """
+    if not os.path.isfile(filename):
+        return
+    legacy = load_credentials_file(filename)
+    for server, password in legacy.items():
+        # a server file that already exists is newer than the legacy entry
+        if not os.path.exists(credentials_file(dirname, server)):
+            save_credentials(dirname, server, password, log=debug)
+    migrated = load_credentials(dirname)
+    if all(server in migrated for server in legacy):
+        info('Migrated credentials to:', dirname)
+        _CRED_CACHE.pop(filename, None)
+        try:
+            os.remove(filename)
+        except OSError:
+            warning('Could not remove file:', filename)
+
+
 def get_username_password(args):
     username = args.username
     password = args.password
     if not password:
-        credentials = load_credentials(CREDENTIALS_FILE)
+        # --no-password-cache must not write any credential files
+        if not args.no_password_cache:
+            migrate_credentials(LEGACY_CREDENTIALS_FILE, CREDENTIALS_DIR)
         key = args.server
+        credentials = load_credentials_file(credentials_file(CREDENTIALS_DIR, key))
+        if key not in credentials and args.no_password_cache:
+            # not migrated: read the legacy file, but leave it in place
+            credentials = load_credentials_file(LEGACY_CREDENTIALS_FILE)
         if key in credentials:
             password = credentials.get(key)
         else:
             password = getpass('Password:')
             if not args.no_password_cache:
-                save_credentials(CREDENTIALS_FILE, args.server, password)
+                save_credentials(CREDENTIALS_DIR, args.server, password)
     return username, password
 
 
@@ -87,6 +176,9 @@ def parse_arguments():
                         help='password for connecting to proxmox')
     parser.add_argument('--ssh-port', default=22,
                         help='SSH port to be used to connect to the server')
+    parser.add_argument('--ssh-cipher', default='aes128-gcm@openssh.com',
+                        help='SSH cipher to be used (default: aes128-gcm@openssh.com,'
+                             ' use "" for the ssh default)')
     parser.add_argument('--config', '-c',
                         help='config file for VM settings')
     parser.add_argument('--image', '-i',
@@ -102,6 +194,16 @@ def parse_arguments():
     parser.add_argument('--replace', action='store_true',
                         help='replaced the VM if exists')
     parser.add_argument('--id', help='VM ID to be used')
+    parser.add_argument('--convert-coroutines', type=int, default=8,
+                        help='parallel coroutines for qemu-img convert (default: 8)')
+    parser.add_argument('--sparse-size', type=int,
+                        help='qemu-img zero detection size in bytes (default: 65536'
+                             ' for block devices, else 4096); 0 disables zero'
+                             ' detection and fully allocates the target')
+    parser.add_argument('--stream-image', action='store_true',
+                        help='let qemu-img read http(s) images directly instead of'
+                             ' downloading them first (the web server must support'
+                             ' HEAD and range requests)')
     parser.add_argument('--no-cleanup', action='store_true',
                         help='do not remove downloaded image')
     parser.add_argument('--no-password-cache', action='store_true',
@@ -118,16 +220,27 @@ def step(*message, **kwargs):
 
 
 def show_config(config, func=print):
+    if func is debug and not is_debug():
+        return
     delimiter = '-'*55
-    func(delimiter + '\n' + yaml.dump(config).strip())
+    lines = [f'{key}: {value}' for key, value in sorted(config.items())]
+    func('\n'.join([delimiter, *lines]))
     func(delimiter)
 
 
-def encode_ssh_keys(keys):
+def fetch_ssh_keys(url):
+    return get_session().get(url, timeout=(3, 10)).content
+
+
+def encode_ssh_keys(keys, download=None):
+    """Return sshkeys (file, URL or literal keys) URL-encoded for the API.
+
+    download may be a future of an earlier fetch_ssh_keys() call for the URL.
+    """
     if keys.startswith('/'):
         key_file = keys
         try:
-            with open(key_file) as fd:
+            with open(key_file, 'rb') as fd:
                 keys = fd.read()
                 if not keys:
                     error('There is no key in file:', key_file)
@@ -137,14 +250,64 @@ def encode_ssh_keys(keys):
             error('Could not open sshkeys file:', key_file)
         except:
             error('Could not read sshkeys file:', key_file)
-
-    if keys.startswith('http'):
+    elif keys.startswith('http'):
         url = keys
         try:
-            keys = requests.get(url).text
+            keys = download.result() if download else fetch_ssh_keys(url)
         except:
             error('Could not load sshkeys from url:', url)
-    return urlparse.quote(keys, safe='')
+    else:
+        keys = keys.encode()
+    return urlparse.quote_from_bytes(keys, safe='')
+
+
+def prepare_image(proxmox, image, temp_dir, cleanup=True, stream=False):
+    """Make an image available to qemu-img on the server.
+
+    URL images are downloaded to temp_dir, unless stream is set and qemu-img
+    can read them directly.
+    Returns the path or URL to convert from, the image name to show to the
+    user and the shell commands to run right before the conversion.
+    """
+    if not image.startswith('http'):
+        # open the ssh connection and probe qemu-img ahead of the conversion,
+        # which then checks that the image exists in the same session
+        proxmox.qemu_img_help()
+        message = f'Image does not exist on the server: {image}'
+        return image, image, [
+            f'test -e {quote(image)} || {{ echo {quote(message)} >&2; exit 1; }}',
+        ]
+
+    url = urlparse.urlsplit(image)
+    # strip user:password@ from the URL before showing it anywhere
+    host_location = url.netloc.rpartition('@')[2]
+    display_image = urlparse.urlunsplit(url._replace(netloc=host_location))
+    if stream and url.scheme in proxmox.qemu_img_formats():
+        # qemu-img reads the image straight from the URL
+        info('Streaming image:', display_image)
+        return image, display_image, []
+
+    image_path = f'{temp_dir}/qcow2-image'
+    info('Downloading image:', display_image)
+    proxmox.run_ssh_script([
+        f'mkdir {quote(temp_dir)}',
+        # do not leave a partial download behind
+        f'trap {quote(f"rm -rf {quote(temp_dir)}")} ERR',
+        f'curl -fLo {quote(image_path)} {quote(image)}',
+    ])
+    script = []
+    if cleanup:
+        # remove the downloaded image in the same session, even on failure
+        script.append(f'trap {quote(f"rm -rf {quote(temp_dir)}")} EXIT')
+    return image_path, display_image, script
+
+
+def abort_download(proxmox, temp_dir):
+    """Stop a download started by prepare_image() and remove its files."""
+    proxmox.run_ssh_script([
+        f'pkill -f -- {quote(temp_dir)} || true',
+        f'rm -rf {quote(temp_dir)}',
+    ])
 
 
 def main():
@@ -156,21 +319,26 @@ def main():
 
     verify_ssl=True
     if args.insecure:
+        import urllib3
         urllib3.disable_warnings()
         verify_ssl=False
 
     username, password = get_username_password(args)
+    from proxmoxer.core import AuthenticationError
+    from lib.proxmox import ProxmoxNode, poll
     try:
         proxmox = ProxmoxNode(
             host=args.server,
             user=username,
             password=password,
             ssh_port=args.ssh_port,
+            ssh_cipher=args.ssh_cipher,
             verify_ssl=verify_ssl,
         )
     except AuthenticationError:
-        clean_credentials(CREDENTIALS_FILE, args.server)
+        clean_credentials(CREDENTIALS_DIR, args.server)
         error('Proxmox login credentials are not correct')
+    atexit.register(proxmox.close)
 
     vm_options = load_defaults(preset=args.preset)
     if args.config:
@@ -226,72 +394,66 @@ def main():
                 descending = True
             new_id = proxmox.get_available_id(base_id, descending=descending)
 
+    if args.image:
+        image = args.image
+
+    # Download sshkeys while the user reads the summary; all Proxmox API
+    # calls stay on this thread, proxmoxer's session is not thread-safe
+    executor = ThreadPoolExecutor(max_workers=2)
+    ssh_keys_download = None
+    if str(vm_options.get('sshkeys', '')).startswith('http'):
+        # errors are reported by encode_ssh_keys() after the prompt
+        ssh_keys_download = executor.submit(fetch_ssh_keys, vm_options['sshkeys'])
+
     info(f'About to create a new {label}:')
     step(f'ID: {new_id}')
     step(f'Name: {vm_name}')
     if not args.assumeyes:
         yn = input('Continue [yN]? ')
         if yn != 'y' and yn != 'Y':
+            executor.shutdown(wait=False, cancel_futures=True)
             return
 
+    # handle ssh_keys; before destroy, so a failed download leaves an
+    # existing VM in place
+    if 'sshkeys' in vm_options:
+        vm_options['sshkeys'] = encode_ssh_keys(
+            vm_options['sshkeys'], download=ssh_keys_download)
+
     if replace:
         proxmox.destroy(new_id)
 
-    # handle ssh_keys
-    if 'sshkeys' in vm_options:
-        ssh_keys = encode_ssh_keys(vm_options['sshkeys'])
-        vm_options['sshkeys'] = ssh_keys
-
     info('Creating VM')
     proxmox.create(new_id, vm_name, vm_options)
 
-    # Find disk_path
-    disk_path = None
-    more_attempts = 10
-    while not disk_path:
-        # trying to read vm config
-        # (may take more than one call - depending on the performance of the host)
-        disk0 = proxmox.get(new_id).config.get().get('scsi0')
-        if disk0:
-            volume_id = disk0.split(',')[0]
-            disk_path = proxmox.get_disk_path(volume_id)
-        more_attempts -= 1
-        if not more_attempts:
-            error('Could not find disk definition.')
-        time.sleep(1)
+    # Prepare the image in the background while the disk is being set up
+    if image:
+        temp_dir = f'/tmp/{uuid.uuid4()}'
+        prepared = executor.submit(
+            prepare_image, proxmox, image, temp_dir, cleanup=not args.no_cleanup,
+            stream=args.stream_image)
+    executor.shutdown(wait=False)
 
-    if args.image:
-        image = args.image
+    # Find disk_path
+    # (may take more than one call - depending on the performance of the host)
+    disk_path = poll(lambda: proxmox.find_disk_path(new_id))
+    if not disk_path:
+        if image:
+            # do not wait for (and keep) a download nobody is going to use
+            prepared.cancel()
+            abort_download(proxmox, temp_dir)
+        error('Could not find disk definition.')
 
     if image:
-        if image.startswith('http'):
-            temp_dir = f'/tmp/{uuid.uuid4()}'
-            image_path = f'{temp_dir}/qcow2-image'
-            info('Create temp directory on the server')
-            proxmox.run_ssh(f'mkdir {temp_dir}; ls -l /tmp')
-
-            url_parts = image.split('://')
-            host_location = url_parts[1].split('@')[-1]
-            display_image = f'{url_parts[0]}://{host_location}'
-            info('Downloading image:', display_image)
-            proxmox.run_ssh(f'curl -Lo {image_path} {image}')
-            image = display_image
-        else:
-            # check if image exists on server
-            stdout = proxmox.run_ssh(f'ls {image} 2>/dev/null', return_stdout=True).strip()
-            if stdout != image:
-                error('Image does not exist on the server:', image)
-            image_path = image
-
+        image_path, image, script = prepared.result()
         info('Converting qcow2 image to LVM thin volume')
-        proxmox.run_ssh(f'qemu-img convert -O raw {image_path} -S 4096 {disk_path}')
+        script.append(proxmox.qemu_img_convert_command(
+            image_path, disk_path, coroutines=args.convert_coroutines,
+            sparse_size=args.sparse_size))
+        proxmox.run_ssh_script(script)
         proxmox.set_image_origin(new_id, image)
-
-        if not args.no_cleanup and image.startswith('http'):
-            info('Cleaning up')
-            proxmox.run_ssh(f'rm -rf {temp_dir}')
     else:
-        warn(f'No image provided. Creating an empty {label}')
+        warning(f'No image provided. Creating an empty {label}')
 
     if args.template:
         info('Converting VM into template')
@@ -1,11 +1,27 @@
+import copy
+import functools
+import os
 import yaml
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+
+@functools.lru_cache(maxsize=32)
+def parse_config(path, mtime_ns, size):
+    """Parse a config file; mtime_ns and size invalidate the memoized result."""
+    with open(path) as fd:
+        return yaml.load(fd, Loader=SafeLoader)
+
 
 def load_config(filename):
     config = {}
     try:
-        with open(filename) as fd:
-            config.update(yaml.safe_load(fd))
+        stat = os.stat(filename)
+        data = parse_config(os.path.abspath(filename), stat.st_mtime_ns, stat.st_size)
+        config.update(copy.deepcopy(data))
     except FileNotFoundError:
         pass
     return config
@@ -1,5 +1,16 @@
-from os.path import isfile
+import copy
+import functools
+import os
 import yaml
+from stat import S_ISREG
+from types import MappingProxyType
+
+from lib.log import warning
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 
 
 DEFAULTS = {
@@ -24,16 +35,36 @@ PRESETS = {
     },
 }
 
+# DEFAULTS with each preset applied, merged once at import time
+PRESET_DEFAULTS = {
+    name: MappingProxyType({**DEFAULTS, **preset})
+    for name, preset in PRESETS.items()
+}
+
+
+@functools.lru_cache(maxsize=32)
+def load_defaults_file(path, mtime_ns, size):
+    """Parse a defaults file, memoized in-process.
+
+    mtime_ns and size are part of the cache key so that a modified file is
+    parsed again.
+    """
+    with open(path) as fd:
+        return yaml.load(fd, Loader=SafeLoader) or {}
+
 
 def load_defaults(filename='default_vm_options.yaml', preset=''):
-    defaults = DEFAULTS.copy()
-    if isfile(filename):
-        with open(filename) as fd:
-            defaults.update(yaml.safe_load(fd))
-
-    if preset:
-        if preset not in PRESETS:
-            warn('Unknown preset:', preset)
-        else:
-            defaults.update(PRESETS.get(preset))
-    return defaults
+    if preset and preset not in PRESETS:
+        warning('Unknown preset:', preset)
+        preset = ''
+
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        stat = None
+    if stat and S_ISREG(stat.st_mode):
+        data = load_defaults_file(
+            os.path.abspath(filename), stat.st_mtime_ns, stat.st_size)
+        # file options override DEFAULTS, the preset overrides both
+        return {**DEFAULTS, **copy.deepcopy(data), **PRESETS.get(preset, {})}
+    return dict(PRESET_DEFAULTS.get(preset, DEFAULTS))
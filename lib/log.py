@@ -15,6 +15,10 @@ def set_debug():
         level=logging.DEBUG,
         datefmt=DATE_FORMAT)
 
+def is_debug():
+    """Check whether DEBUG messages are emitted."""
+    return logging.root.isEnabledFor(logging.DEBUG)
+
 def format_msg(*msg):
     """Concatenate all log messages."""
     return ' '.join([str(s) for s in [*msg]])
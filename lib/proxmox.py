@@ -1,35 +1,109 @@
 from proxmoxer import ProxmoxAPI
 from proxmoxer.core import ResourceException
-from subprocess import run, PIPE, CalledProcessError
+from shlex import quote
+from subprocess import run, DEVNULL, PIPE, CalledProcessError
+import os
+import shutil
+import tempfile
+import threading
 import time
 
 from lib.log import *
 
 
+# Multiplex all ssh invocations of a node over one master connection
+SSH_OPTIONS = [
+    '-o', 'ControlMaster=auto',
+    '-o', 'ControlPersist=60s',
+    # images are qcow2 (already compressed) and no tty is needed
+    '-o', 'Compression=no',
+    '-T',
+]
+
+
+def poll(fn, min_delay=0.05, base=1.3, max_delay=5.0, timeout=30):
+    """Call fn() with exponential backoff until it returns a truthy value.
+
+    Returns that value, or None if the timeout expires first.
+    """
+    delay = min_delay
+    deadline = time.monotonic() + timeout
+    while True:
+        result = fn()
+        if result:
+            return result
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        time.sleep(min(delay, remaining))
+        delay = min(delay * base, max_delay)
+
+
 class ProxmoxNode(object):
 
-    def __init__(self, host, user, password, ssh_port=22, node=None, **kwargs):
+    def __init__(self, host, user, password, ssh_port=22, node=None,
+                 ssh_cipher='aes128-gcm@openssh.com', **kwargs):
         self.host = host
         self.user = user
         self.password = password
         self.ssh_port = str(ssh_port)
+        self.ssh_cipher = ssh_cipher
+        self._ssh_targets = {}
+        self._qemu_img_help = None
+        self._qemu_img_help_lock = threading.Lock()
+        self._storages = {}
+        self._inventory = None
+        self._name_to_id = {}
+        self._vms_by_id = {}
 
         self.proxmox = ProxmoxAPI(host=host, user=user, password=password, **kwargs)
-        nodes = [d['node'] for d in self.proxmox.nodes.get()]
+        self.nodes = {d['node']: d for d in self.proxmox.nodes.get()}
         # select node - if not specified, pick the first one
         if node:
-            if node not in nodes:
+            if node not in self.nodes:
                 error('Specified node {} not configured on host {}'.format(
-                    host, node))
+                    node, host))
             self.node_name = node
         else:
-            self.node_name = nodes[0]
+            self.node_name = next(iter(self.nodes))
         self.node = self.proxmox.nodes(self.node_name)
         self.get_vm_ids()
 
+        # private, short directory for the ssh control sockets: a path in
+        # the macOS $TMPDIR exceeds the 104 byte socket path limit. %C
+        # hashes host, port and user, so each user gets its own master.
+        self.ssh_control_dir = tempfile.mkdtemp(prefix='pmx-', dir='/tmp')
+        ssh_control_path = os.path.join(self.ssh_control_dir, '%C')
+        # fixed part of every ssh command line, followed by user@host
+        self._ssh_prefix = ['ssh', *SSH_OPTIONS, '-o', f'ControlPath={ssh_control_path}']
+        if ssh_cipher:
+            self._ssh_prefix += ['-c', ssh_cipher]
+        self._ssh_prefix += ['-p', self.ssh_port]
+
+    def get_inventory(self, ttl=2.0):
+        """Return the VMs of the node, fetched at most once every ttl seconds."""
+        now = time.monotonic()
+        if self._inventory is None or now - self._inventory[0] > ttl:
+            vms = self.node.qemu.get()
+            self._inventory = (now, vms)
+            # index by name; on duplicate names the first VM listed wins
+            self._name_to_id = {vm.get('name'): int(vm['vmid'])
+                                for vm in reversed(vms)}
+            self._vms_by_id = {int(vm['vmid']): vm for vm in vms}
+        return self._inventory[1]
+
+    def find_vm(self, id, ttl=2.0):
+        """Return the cached inventory entry (name, status, ...) of a VM."""
+        self.get_inventory(ttl)
+        return self._vms_by_id.get(int(id))
+
+    def invalidate(self):
+        """Forget the cached VM list after VMs have been changed."""
+        self._inventory = None
+
     def get_vm_ids(self):
         self.vm_ids = []
-        for vm in self.node.qemu.get():
+        for vm in self.get_inventory():
             self.vm_ids.append(int(vm['vmid']))
 
     def get_available_id(self, base_id, descending=False):
@@ -39,24 +113,29 @@ class ProxmoxNode(object):
 
         # find next free vm id starting at base_id
         self.get_vm_ids()
+        used = set(self.vm_ids)
         new_id = base_id + increment
-        for id in sorted(self.vm_ids, reverse=descending):
-            if id == new_id:
-                new_id += increment
+        while new_id in used:
+            new_id += increment
         return new_id
 
     def find_vm_id(self, name, ignore_missing=False):
-        for vm in self.node.qemu.get():
-            if name == vm['name']:
-                return vm['vmid']
-        if not ignore_missing:
+        self.get_inventory()
+        vm_id = self._name_to_id.get(name)
+        if vm_id is None and not ignore_missing:
             error('ID could not be found for VM name:', name)
+        return vm_id
 
     def get(self, id):
         vm = self.node.qemu(id)
         return vm
 
+    def exists_by_id(self, id):
+        return self.find_vm(id) is not None
+
     def exists(self, id):
+        if self.exists_by_id(id):
+            return True
         try:
             vm = self.get(id).status.current.get()
             return True
@@ -64,7 +143,9 @@ class ProxmoxNode(object):
             return False
 
     def get_name(self, id):
-        vm = self.get(id).status.current.get()
+        vm = self.find_vm(id)
+        if vm is None:
+            vm = self.get(id).status.current.get()
         return vm['name']
 
     def clone(self, template_id, vm_id):
@@ -74,12 +155,18 @@ class ProxmoxNode(object):
         if 'cpu' in vm_options and not vm_options['cpu']:
             del(vm_options['cpu'])
         self.node.qemu.create(vmid=id, name=name, **vm_options)
+        self.invalidate()
 
     def start(self, id):
         self.get(id).status.start.post()
+        self.invalidate()
 
     def is_running(self, id):
-        return self.get(id).status.current.get().get('status') == 'running'
+        # short ttl, as this is used to wait for a VM to stop
+        vm = self.find_vm(id, ttl=0.5)
+        if vm is None:
+            vm = self.get(id).status.current.get()
+        return vm.get('status') == 'running'
 
     def convert(self, id):
         name = self.get_name(id)
@@ -87,16 +174,15 @@ class ProxmoxNode(object):
         description = vm.config.get().get('description')
         vm.config.set(description=f'Branched off {name} -- {description}')
         vm.template().post()
+        self.invalidate()
 
     def destroy(self, id):
-        i = 0
-        while i < 30 and self.is_running(id):
-            if not i:
-                info('Stopping VM', id)
+        if self.is_running(id):
+            info('Stopping VM', id)
             self.get(id).status.stop.post()
-            time.sleep(1)
-            i += 1
+            poll(lambda: not self.is_running(id))
         self.get(id).delete()
+        self.invalidate()
 
     def set_options(self, id, options):
         self.get(id).config.set(**options)
@@ -105,27 +191,112 @@ class ProxmoxNode(object):
         description = f'Created based on {image}'
         self.get(id).config.set(description=description)
 
-    def run_ssh(self, command, user='root', return_stdout=False):
-        ssh_command = ['ssh', '-p', self.ssh_port, f'{user}@{self.host}', command]
+    def run_ssh(self, command, user='root', return_stdout=False, input=None):
+        target = self._ssh_targets.get(user)
+        if target is None:
+            target = self._ssh_targets[user] = f'{user}@{self.host}'
+        ssh_command = [*self._ssh_prefix, target, command]
         debug('Run:', ' '.join(ssh_command))
+        # only capture output somebody is going to look at
+        stdout = PIPE if return_stdout or is_debug() else DEVNULL
         try:
-            result = run(ssh_command, stdout=PIPE, check=True, encoding='utf8')
+            if input is None:
+                # never let ssh read from the terminal
+                result = run(ssh_command, stdin=DEVNULL, stdout=stdout, check=True,
+                             encoding='utf8')
+            else:
+                result = run(ssh_command, stdout=stdout, check=True, encoding='utf8',
+                             input=input)
         except CalledProcessError:
-            error('Could not execute ssh command: "{}"'.format(
-                  ' '.join(ssh_command)))
+            message = 'Could not execute ssh command: "{}"'.format(' '.join(ssh_command))
+            if input is not None:
+                # scripts from run_ssh_script(): show which commands failed
+                message += '\nScript:\n' + input
+            error(message)
         if return_stdout:
             return result.stdout
         if result.stdout:
             debug('SSH output:', result.stdout)
 
+    def run_ssh_script(self, lines, user='root', return_stdout=False):
+        """Run shell commands in a single ssh session, stopping at the first error."""
+        script = '\n'.join(['set -e', *lines]) + '\n'
+        debug('Script:', script)
+        return self.run_ssh('bash -s', user=user, return_stdout=return_stdout,
+                            input=script)
+
+    def close(self):
+        """Stop the shared ssh master connections and remove their sockets."""
+        for target in self._ssh_targets.values():
+            run([*self._ssh_prefix, '-O', 'exit', target],
+                stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL)
+        shutil.rmtree(self.ssh_control_dir, ignore_errors=True)
+
     def find_storage(self, type='lvmthin'):
-        storage_list = self.proxmox.storage.get(type=type)
-        if storage_list:
-            return storage_list[0].get('storage')
-        else:
-            return None
+        if type not in self._storages:
+            storage_list = self.proxmox.storage.get(type=type)
+            if storage_list:
+                self._storages[type] = storage_list[0].get('storage')
+            else:
+                self._storages[type] = None
+        return self._storages[type]
+
+    def find_disk_path(self, id, disk='scsi0'):
+        """Return the path of a VM disk, or None if it is not configured yet."""
+        disk_config = self.get(id).config.get().get(disk)
+        if disk_config:
+            volume_id = disk_config.split(',')[0]
+            return self.get_disk_path(volume_id)
+
+    def refresh_storages(self):
+        """Forget the storages cached by find_storage()."""
+        self._storages.clear()
 
     def get_disk_path(self, volume_id):
         storage = self.find_storage()
         volume = self.node.storage.get(f'{storage}/content/{volume_id}')
         return volume.get('path')
+
+    def qemu_img_help(self):
+        """Return the (cached) output of 'qemu-img --help' on the server."""
+        with self._qemu_img_help_lock:
+            if self._qemu_img_help is None:
+                self._qemu_img_help = self.run_ssh(
+                    'qemu-img --help || true', return_stdout=True)
+        return self._qemu_img_help
+
+    def qemu_img_formats(self):
+        """Return the formats and protocols supported by qemu-img on the server."""
+        for line in self.qemu_img_help().splitlines():
+            if line.startswith('Supported formats:'):
+                return line.split(':', 1)[1].split()
+        return []
+
+    def qemu_img_convert_command(self, source, target, coroutines=8,
+                                 sparse_size=None):
+        """Build a qemu-img command converting a qcow2 image to a raw disk.
+
+        The source may be a path on the server or an http(s) URL, which
+        qemu-img then reads directly through its curl block driver.
+        sparse_size is passed as -S; by default 64k for block devices and
+        4k for files. 0 disables zero detection, so every zero block is
+        written and a thin target gets fully allocated.
+        """
+        qemu_img_help = self.qemu_img_help()
+        block_target = target.startswith('/dev/')
+        options = ['-f', 'qcow2', '-O', 'raw']
+        if block_target and '[-U]' in qemu_img_help:
+            options += ['--force-share']
+        # parallel coroutines with out-of-order writes (qemu >= 2.9)
+        if '[-W]' in qemu_img_help:
+            options += ['-m', str(coroutines), '-W']
+        options += ['-t', 'none']
+        if '://' not in source:
+            options += ['-T', 'none']
+        if sparse_size is None:
+            # thin-pool block devices: coarser zero detection, matching the
+            # minimum thin-pool chunk size
+            sparse_size = 65536 if block_target else 4096
+        options += ['-S', str(sparse_size)]
+        return ' '.join(['qemu-img', 'convert', *options,
+                         quote(source), quote(target)])